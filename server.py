@@ -9,15 +9,36 @@ import websockets
 import json
 import base64
 import socket
+import struct
 import uuid
+from collections import deque
 from datetime import datetime
 
+# Explicit permessage-deflate configuration (older websockets versions lack it)
+try:
+    from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+except ImportError:
+    ServerPerMessageDeflateFactory = None
+
+# orjson is optional: a much faster JSON encoder/decoder
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# uvloop is optional: a faster libuv-based event loop (not available on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Store all connected clients
 connected_clients = set()
 
 # Store chat history for the current session
-chat_history = []
 MAX_HISTORY_ITEMS = 1000  # Limit to prevent memory issues
+chat_history = deque(maxlen=MAX_HISTORY_ITEMS)  # Oldest items drop off automatically
+history_payload = None  # Encoded history message, rebuilt after the history changes
 
 # Store large file chunks temporarily
 file_chunks_storage = {}
@@ -25,6 +46,32 @@ file_chunks_storage = {}
 # Map client IDs to their websocket connections
 client_connections = {}  # {client_id: websocket}
 
+# Binary file chunk frames: header followed by the raw chunk bytes
+# Header layout: frame type, chunk index, total chunks, file ID (NUL-padded)
+FILE_ID_SIZE = 32
+CHUNK_HEADER = struct.Struct(f"!BII{FILE_ID_SIZE}s")
+BINARY_FILE_CHUNK = 1
+FILE_CHUNK_SIZE = 512 * 1024  # Same chunk size the browser client uses
+
+# Bounded outbound queue per client, drained by a dedicated writer task
+send_queues = {}  # {websocket: FrameQueue}
+SEND_QUEUE_SIZE = 64  # Frames buffered per client before backpressure applies
+SEND_QUEUE_BYTES = 4 * FILE_CHUNK_SIZE  # ...or once this much data is waiting
+
+# Snapshot of (websocket, send queue) pairs, rebuilt only on connect/disconnect
+broadcast_targets = []
+
+# Online count broadcasts are debounced so connection storms send one update
+ONLINE_COUNT_DELAY = 0.2  # seconds
+online_count_handle = None  # Pending scheduled broadcast, if any
+last_online_count = (None, None)  # (count, encoded payload) of the last broadcast
+
+# Messages larger than this are parsed in a worker thread, not on the event loop
+LARGE_MESSAGE_SIZE = 256 * 1024
+
+# Log only the first, last and every Nth chunk of a file transfer
+CHUNK_LOG_INTERVAL = 100
+
 def get_local_ip():
     """
     Automatically detect the local LAN IP address
@@ -42,62 +89,193 @@ def get_local_ip():
         print(f"Error detecting IP: {e}")
         return "127.0.0.1"
 
+def encode_message(message):
+    """
+    Serialize a message into the wire format sent to clients
+    Dicts are encoded once; already-encoded payloads pass through unchanged
+    """
+    if isinstance(message, dict):
+        if orjson is not None:
+            # orjson returns compact UTF-8 bytes; text frames need str
+            return orjson.dumps(message).decode("utf-8")
+        # Compact separators: no padding spaces on the wire
+        return json.dumps(message, separators=(",", ":"))
+    return message
+
+def decode_message(message):
+    """
+    Parse an incoming wire message into a dict
+    Raises json.JSONDecodeError if the payload is malformed
+    (orjson.JSONDecodeError is a subclass of it)
+    """
+    if orjson is not None:
+        return orjson.loads(message)
+    return json.loads(message)
+
+class FrameQueue(asyncio.Queue):
+    """
+    Outbound frame queue bounded by total payload size as well as frame count
+    Keeps a slow client from holding dozens of 512KB file chunks in memory
+    """
+    def __init__(self, maxsize, max_bytes):
+        super().__init__(maxsize)
+        self.max_bytes = max_bytes
+        self.queued_bytes = 0
+    
+    def full(self):
+        return super().full() or self.queued_bytes >= self.max_bytes
+    
+    def _put(self, item):
+        super()._put(item)
+        self.queued_bytes += len(item)
+    
+    def _get(self):
+        item = super()._get()
+        self.queued_bytes -= len(item)
+        return item
+
+def should_log_chunk(chunk_index, total_chunks):
+    """
+    Decide whether a file chunk is worth a log line
+    Logging every chunk would block the event loop on stdout for large files
+    """
+    return (chunk_index == 0
+            or chunk_index == total_chunks - 1
+            or (chunk_index + 1) % CHUNK_LOG_INTERVAL == 0)
+
+def refresh_broadcast_targets():
+    """
+    Rebuild the broadcast snapshot after a client connects or disconnects
+    Broadcasts iterate this list instead of the client set on every message
+    """
+    global broadcast_targets
+    broadcast_targets = list(send_queues.items())
+
+async def writer_loop(websocket, send_queue):
+    """
+    Send queued frames to a client in order
+    Frames are taken one at a time, so the queue holds the whole backlog
+    """
+    while True:
+        frame = await send_queue.get()
+        try:
+            await websocket.send(frame)
+        except asyncio.CancelledError:
+            # Python 3.7 treats cancellation as an Exception; let it stop the writer
+            raise
+        except Exception:
+            # Keep draining so senders never block on a dead connection;
+            # the disconnect itself is handled by handle_client
+            pass
+
 async def broadcast_message(message, sender=None):
     """
     Send a message to all connected clients except the sender
     Args:
-        message: The message to broadcast (string or dict)
+        message: The message to broadcast (string, bytes or dict)
         sender: The websocket connection of the sender (optional)
     """
-    if connected_clients:
-        # Convert message to JSON string if it's a dict
-        message_str = json.dumps(message) if isinstance(message, dict) else message
+    if broadcast_targets:
+        # Encode the message once, shared by every receiver
+        message_str = encode_message(message)
         
-        # Create tasks to send to all clients
-        tasks = []
-        for client in connected_clients:
+        # Queue for all clients; clients with a full queue slow the sender down
+        blocked = None  # Only allocated when some queue is actually full
+        for client, send_queue in broadcast_targets:
             # Don't send back to the sender
-            if client != sender:
-                tasks.append(client.send(message_str))
+            if client is sender:
+                continue
+            try:
+                send_queue.put_nowait(message_str)
+            except asyncio.QueueFull:
+                if blocked is None:
+                    blocked = []
+                blocked.append(send_queue)
         
-        # Send to all clients concurrently
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        if blocked:
+            await asyncio.gather(*(send_queue.put(message_str) for send_queue in blocked))
+
+async def broadcast_file(file_info, content, sender=None):
+    """
+    Relay a complete file to all clients except the sender as a binary transfer
+    Args:
+        file_info: File metadata (filename, filesize, sender details)
+        content: The raw file bytes
+        sender: The websocket connection of the sender (optional)
+    """
+    file_id = uuid.uuid4().hex  # 32 ASCII characters, fills the header field
+    file_id_bytes = file_id.encode("ascii")
+    total_chunks = max(1, -(-len(content) // FILE_CHUNK_SIZE))
+    
+    # Announce the transfer, then stream the content as binary chunks
+    announcement = dict(file_info, type="file_start", fileId=file_id, totalChunks=total_chunks)
+    await broadcast_message(announcement, sender=sender)
+    
+    # Slice through a memoryview so only one chunk is copied at a time
+    view = memoryview(content)
+    for chunk_index in range(total_chunks):
+        start = chunk_index * FILE_CHUNK_SIZE
+        header = CHUNK_HEADER.pack(BINARY_FILE_CHUNK, chunk_index, total_chunks, file_id_bytes)
+        await broadcast_message(header + view[start:start + FILE_CHUNK_SIZE], sender=sender)
+
+def schedule_online_count():
+    """
+    Broadcast the online count once connects/disconnects settle
+    Changes within ONLINE_COUNT_DELAY of each other share one broadcast
+    """
+    global online_count_handle
+    
+    if online_count_handle is None:
+        loop = asyncio.get_running_loop()
+        online_count_handle = loop.call_later(ONLINE_COUNT_DELAY, broadcast_online_count)
 
-async def broadcast_online_count():
+def broadcast_online_count():
     """
     Broadcast the current number of connected clients to all clients
     """
+    global online_count_handle, last_online_count
+    online_count_handle = None
+    
     if connected_clients:
-        message = json.dumps({
-            "type": "online_count",
-            "count": len(connected_clients)
-        })
-        
-        # Create tasks to send to all clients
-        tasks = [client.send(message) for client in connected_clients]
+        # Reuse the encoded payload when the count hasn't changed
+        count = len(connected_clients)
+        if last_online_count[0] == count:
+            message = last_online_count[1]
+        else:
+            message = encode_message({
+                "type": "online_count",
+                "count": count
+            })
+            last_online_count = (count, message)
         
-        # Send to all clients concurrently
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        for client, send_queue in broadcast_targets:
+            try:
+                send_queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # The count is refreshed on every connect/disconnect, safe to drop
+                pass
 
 async def send_chat_history(websocket, client_id):
     """
     Send chat history to a newly connected client along with their client ID
     """
+    global history_payload
+    
     try:
         # First, send the client their unique ID
-        await websocket.send(json.dumps({
+        await websocket.send(encode_message({
             "type": "client_id",
             "clientId": client_id
         }))
         
-        # Then send history message
+        # Then send history message (encoded once, shared by every new client)
         if chat_history:
-            await websocket.send(json.dumps({
-                "type": "history",
-                "messages": chat_history
-            }))
+            if history_payload is None:
+                history_payload = encode_message({
+                    "type": "history",
+                    "messages": list(chat_history)
+                })
+            await websocket.send(history_payload)
     except Exception as e:
         print(f"Error sending chat history: {e}")
 
@@ -106,7 +284,7 @@ def add_to_history(message_data):
     Add a message to chat history
     Only stores text messages and file metadata (not the actual file content)
     """
-    global chat_history
+    global history_payload
     
     # Don't store file chunks in history
     if message_data.get("type") == "file_chunk":
@@ -127,16 +305,16 @@ def add_to_history(message_data):
         }
     else:
         # Store complete message for text with client ID
-        history_item = message_data.copy()
+        # Shared with the broadcast, which only serializes it - no copy needed
+        history_item = message_data
         # Ensure clientId is included
         if "clientId" not in history_item:
             history_item["clientId"] = message_data.get("sender")
     
     chat_history.append(history_item)
     
-    # Limit history size
-    if len(chat_history) > MAX_HISTORY_ITEMS:
-        chat_history = chat_history[-MAX_HISTORY_ITEMS:]
+    # The cached history payload is now stale
+    history_payload = None
 
 async def handle_client(websocket, path=None):
     """
@@ -147,6 +325,12 @@ async def handle_client(websocket, path=None):
     # Add new client to the set before getting ID
     connected_clients.add(websocket)
     
+    # Start the writer task that delivers broadcasts to this client
+    send_queue = FrameQueue(SEND_QUEUE_SIZE, SEND_QUEUE_BYTES)
+    send_queues[websocket] = send_queue
+    refresh_broadcast_targets()
+    writer = asyncio.create_task(writer_loop(websocket, send_queue))
+    
     # Get client IP safely
     try:
         client_ip = websocket.remote_address[0]
@@ -155,10 +339,17 @@ async def handle_client(websocket, path=None):
     
     # Wait for client to send their client ID (or generate new one)
     client_id = None
+    
+    # Binary transfers this connection announced with file_start,
+    # keyed by the file ID exactly as it appears in the chunk header
+    announced_files = set()
+    
+    # Base64 transfers whose first chunk this connection sent (and we re-stamped)
+    stamped_files = {}  # {file_id: (sender_name, sender_pic)}
     try:
         # Receive first message which should contain client_id or connection request
         first_message = await asyncio.wait_for(websocket.recv(), timeout=5.0)
-        data = json.loads(first_message)
+        data = decode_message(first_message)
         
         # Check if client is sending their persistent ID
         if data.get("type") == "register":
@@ -187,14 +378,52 @@ async def handle_client(websocket, path=None):
     await send_chat_history(websocket, client_id)
     
     # Broadcast updated online count to all clients
-    await broadcast_online_count()
+    schedule_online_count()
     
     try:
         # Listen for messages from this client
         async for message in websocket:
             try:
-                # Parse the incoming message
-                data = json.loads(message)
+                # Binary frames carry raw file chunks - relay them untouched
+                # (the time is only read when a line is actually logged)
+                if isinstance(message, bytes):
+                    if len(message) < CHUNK_HEADER.size:
+                        print(f"[{datetime.now().strftime('%H:%M:%S')}] Invalid binary frame from {client_ip}")
+                        continue
+                    
+                    frame_type, chunk_index, total_chunks, file_id = CHUNK_HEADER.unpack_from(message)
+                    if frame_type != BINARY_FILE_CHUNK:
+                        print(f"[{datetime.now().strftime('%H:%M:%S')}] Unknown binary frame type from {client_ip}: {frame_type}")
+                        continue
+                    
+                    # Only relay chunks of transfers this connection announced itself
+                    file_id = file_id.rstrip(b"\0")
+                    if file_id not in announced_files:
+                        if should_log_chunk(chunk_index, total_chunks):
+                            print(f"[{datetime.now().strftime('%H:%M:%S')}] Dropped chunk of unannounced file from {client_ip}")
+                        continue
+                    if chunk_index >= total_chunks - 1:
+                        announced_files.discard(file_id)
+                    
+                    if should_log_chunk(chunk_index, total_chunks):
+                        file_id = file_id.decode("ascii", "replace")
+                        print(f"[{datetime.now().strftime('%H:%M:%S')}] File chunk {chunk_index + 1}/{total_chunks} from {client_ip}: {file_id}")
+                    
+                    # Forward the frame as-is to all other clients
+                    await broadcast_message(message, sender=websocket)
+                    continue
+                
+                # Timestamp the message once, reused for logging and the payload
+                now = datetime.now()
+                log_time = now.strftime('%H:%M:%S')
+                
+                # Parse the incoming message; huge payloads (legacy base64 files)
+                # are parsed off the event loop so other clients aren't stalled
+                if len(message) > LARGE_MESSAGE_SIZE:
+                    loop = asyncio.get_running_loop()
+                    data = await loop.run_in_executor(None, decode_message, message)
+                else:
+                    data = decode_message(message)
                 message_type = data.get("type")
                 
                 # Skip register messages (already handled)
@@ -203,7 +432,7 @@ async def handle_client(websocket, path=None):
                 
                 if message_type == "text":
                     # Handle text message
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] Text from {client_ip}: {data.get('content', '')[:50]}...")
+                    print(f"[{log_time}] Text from {client_ip}: {data.get('content', '')[:50]}...")
                     
                     message_data = {
                         "type": "text",
@@ -212,7 +441,7 @@ async def handle_client(websocket, path=None):
                         "clientId": client_id,
                         "senderName": data.get("senderName", "Anonymous"),
                         "senderPic": data.get("senderPic", ""),
-                        "timestamp": datetime.now().isoformat()
+                        "timestamp": now.isoformat()
                     }
                     
                     # Add to history
@@ -222,42 +451,91 @@ async def handle_client(websocket, path=None):
                     await broadcast_message(message_data, sender=websocket)
                 
                 elif message_type == "file":
-                    # Handle file transfer (small files sent as single message)
+                    # Handle base64 single-message files (sent by older clients)
                     filename = data.get("filename", "unknown")
                     filesize = data.get("filesize", 0)
                     
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] File from {client_ip}: {filename} ({filesize} bytes)")
+                    print(f"[{log_time}] File from {client_ip}: {filename} ({filesize} bytes)")
                     
                     message_data = {
                         "type": "file",
                         "filename": filename,
                         "filesize": filesize,
-                        "content": data.get("content", ""),  # base64 encoded file data
                         "sender": client_ip,
                         "clientId": client_id,
                         "senderName": data.get("senderName", "Anonymous"),
                         "senderPic": data.get("senderPic", ""),
-                        "timestamp": datetime.now().isoformat()
+                        "timestamp": now.isoformat()
                     }
                     
-                    # Add to history (without file content)
+                    # Decode once here (rejecting malformed base64 before anything is
+                    # recorded); drop the base64 copies so only the raw bytes stay in memory
+                    content = base64.b64decode(data.pop("content", ""), validate=True)
+                    del message, data
+                    
+                    # Add to history (file metadata only)
                     add_to_history(message_data)
                     
-                    # Broadcast file to all other clients
-                    await broadcast_message(message_data, sender=websocket)
+                    # Stream it as binary chunks to all other clients
+                    await broadcast_file(message_data, content, sender=websocket)
+                
+                elif message_type == "file_start":
+                    # Announce a chunked transfer; the chunks follow as binary frames
+                    filename = data.get("filename", "unknown")
+                    filesize = data.get("filesize", 0)
+                    total_chunks = data.get("totalChunks", 1)
+                    
+                    print(f"[{log_time}] File from {client_ip}: {filename} ({filesize} bytes, {total_chunks} chunks)")
+                    
+                    # Remember the ID the way the client packs it into chunk headers
+                    file_id = data.get("fileId", "")
+                    announced_files.add(str(file_id).encode("utf-8")[:FILE_ID_SIZE])
+                    
+                    # Broadcast file metadata to all other clients
+                    await broadcast_message({
+                        "type": "file_start",
+                        "fileId": file_id,
+                        "filename": filename,
+                        "filesize": filesize,
+                        "totalChunks": total_chunks,
+                        "sender": client_ip,
+                        "clientId": client_id,
+                        "senderName": data.get("senderName", "Anonymous"),
+                        "senderPic": data.get("senderPic", ""),
+                        "timestamp": now.isoformat()
+                    }, sender=websocket)
                 
                 elif message_type == "file_chunk":
-                    # Handle large file chunks (for files sent in parts)
+                    # Handle base64 file chunks (sent by older clients)
                     filename = data.get("filename", "unknown")
                     chunk_index = data.get("chunkIndex", 0)
                     total_chunks = data.get("totalChunks", 1)
                     
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] File chunk {chunk_index + 1}/{total_chunks} from {client_ip}: {filename}")
+                    if should_log_chunk(chunk_index, total_chunks):
+                        print(f"[{log_time}] File chunk {chunk_index + 1}/{total_chunks} from {client_ip}: {filename}")
+                    
+                    file_id = data.get("fileId", "")
+                    sender_name = data.get("senderName", "Anonymous")
+                    sender_pic = data.get("senderPic", "")
+                    
+                    # Later chunks of a transfer we already stamped are relayed exactly
+                    # as received, as long as they don't claim a different identity
+                    if (chunk_index > 0
+                            and stamped_files.get(file_id) == (sender_name, sender_pic)
+                            and "sender" not in data
+                            and "clientId" not in data):
+                        if chunk_index >= total_chunks - 1:
+                            del stamped_files[file_id]
+                        await broadcast_message(message, sender=websocket)
+                        continue
+                    
+                    if chunk_index == 0 and total_chunks > 1:
+                        stamped_files[file_id] = (sender_name, sender_pic)
                     
-                    # Broadcast chunk to all other clients
+                    # Broadcast chunk with server-stamped sender metadata to all other clients
                     await broadcast_message({
                         "type": "file_chunk",
-                        "fileId": data.get("fileId", ""),
+                        "fileId": file_id,
                         "filename": filename,
                         "filesize": data.get("filesize", 0),
                         "chunk": data.get("chunk", ""),
@@ -265,13 +543,13 @@ async def handle_client(websocket, path=None):
                         "totalChunks": total_chunks,
                         "sender": client_ip,
                         "clientId": client_id,
-                        "senderName": data.get("senderName", "Anonymous"),
-                        "senderPic": data.get("senderPic", ""),
-                        "timestamp": datetime.now().isoformat()
+                        "senderName": sender_name,
+                        "senderPic": sender_pic,
+                        "timestamp": now.isoformat()
                     }, sender=websocket)
                 
                 else:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] Unknown message type from {client_ip}: {message_type}")
+                    print(f"[{log_time}] Unknown message type from {client_ip}: {message_type}")
                     
             except json.JSONDecodeError:
                 print(f"[{datetime.now().strftime('%H:%M:%S')}] Invalid JSON from {client_ip}")
@@ -287,11 +565,18 @@ async def handle_client(websocket, path=None):
         # Remove client from the set when disconnected
         connected_clients.discard(websocket)
         client_connections.pop(client_id, None)
+        send_queues.pop(websocket, None)
+        refresh_broadcast_targets()
+        writer.cancel()
+        
+        # Free the queue so senders waiting on this client are released
+        while not send_queue.empty():
+            send_queue.get_nowait()
         print(f"Total connected clients: {len(connected_clients)}")
         
         # Broadcast updated online count to all clients
         if connected_clients:  # Only broadcast if there are still connected clients
-            asyncio.create_task(broadcast_online_count())
+            schedule_online_count()
 
 async def main():
     """
@@ -320,6 +605,16 @@ async def main():
     print("=" * 60)
     print()
     
+    # Tune permessage-deflate for a better ratio than the library default
+    # (full 32KB windows instead of 4KB, zlib's default memLevel)
+    extensions = None
+    if ServerPerMessageDeflateFactory is not None:
+        extensions = [ServerPerMessageDeflateFactory(
+            server_max_window_bits=15,
+            client_max_window_bits=15,
+            compress_settings={"memLevel": 8}
+        )]
+    
     # Start the WebSocket server with compatibility for all versions
     try:
         # Try newer websockets API (version 10+)
@@ -328,7 +623,8 @@ async def main():
             ws_host, 
             ws_port,
             max_size=None,  # No limit - we're using chunked transfer
-            write_limit=2**20  # 1MB write buffer
+            write_limit=2**20,  # 1MB write buffer
+            extensions=extensions  # Tuned permessage-deflate (compression stays enabled)
         ):
             # Keep the server running
             await asyncio.Future()  # Run forever
@@ -344,6 +640,10 @@ async def main():
 
 if __name__ == "__main__":
     try:
+        # Use uvloop's event loop when it is installed
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        
         # Run the server
         asyncio.run(main())
     except KeyboardInterrupt: